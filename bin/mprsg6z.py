@@ -65,6 +65,7 @@ class Mprsg6zManager(Plugin):
 
 	# get config keys for the vamp
         mprsg6z_device = str(self.get_config('device'))
+        mprsg6z_capture = self.get_config('capture') or ''
         mprsg6z_channel1 = self.get_config('channel1')
         mprsg6z_channel2 = self.get_config('channel2')
         mprsg6z_channel3 = self.get_config('channel3')
@@ -76,7 +77,7 @@ class Mprsg6zManager(Plugin):
 
         # create vamp device and open it
         try:
-            self.mprsg6zvamp = Mprsg6zVamp(self.log, mprsg6z_channels, mprsg6z_device)
+            self.mprsg6zvamp = Mprsg6zVamp(self.log, mprsg6z_channels, mprsg6z_device, mprsg6z_capture)
 	    self.mprsg6zvamp.open()
         except Mprsg6zException as e:
             self.log.error(e.value)
@@ -168,6 +169,25 @@ class Mprsg6zManager(Plugin):
             # Reply MQ REP (acq) to REQ command
             self.send_rep_ack(status, reason, command_id, device_name) ;
 
+        elif msg.get_action() == "mprsg6z.snapshot":
+            # whole vamp state from the cache, no query sent to the amp
+            self.log.debug(u"= = = > Received MQ REQ snapshot message")
+            status = True
+            reason = None
+            snapshot = None
+            try:
+                snapshot = self.mprsg6zvamp.vamp_snapshot()
+            except Exception as e:
+                self.log.error(u"# # # MQ REQ snapshot failed : {0}".format(traceback.format_exc()))
+                status = False
+                reason = u"Plugin mprsg6z: snapshot failed : {0}".format(e)
+            reply_msg = MQMessage()
+            reply_msg.set_action('mprsg6z.snapshot.result')
+            reply_msg.add_data('status', status)
+            reply_msg.add_data('reason', reason)
+            reply_msg.add_data('snapshot', snapshot)
+            self.reply(reply_msg.get())
+
 
     # -------------------------------------------------------------------------------------------------
 
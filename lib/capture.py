@@ -0,0 +1,422 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+
+""" This file is part of B{Domogik} project (U{http://www.domogik.org}).
+
+License
+=======
+
+B{Domogik} is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+B{Domogik} is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Domogik. If not, see U{http://www.gnu.org/licenses}.
+
+Plugin purpose
+==============
+
+Plugin for monoprice mpr-6zhmaut amp
+
+Implements
+==========
+
+Recording of the rs232 traffic of the vamp and offline replay of a capture.
+
+A capture file starts with CAPTURE_MAGIC, followed by records made of a
+CAPTURE_HEADER (monotonic timestamp in seconds, direction, data length) and
+the data. Direction is CAPTURE_OUT for bytes sent to the amp and CAPTURE_IN for
+bytes received from it. A CAPTURE_IN record is stamped with its last byte, a
+CAPTURE_IN record with no data is a read timeout.
+
+@author: jaywax  (jaywax dt 2 dt bourbon at gmail dt com)
+@copyright: (C) 2007-2017 Domogik project
+@license: GPL(v3)
+@organization: Domogik
+"""
+
+import struct
+import time
+import copy
+import os
+
+CAPTURE_MAGIC = b'MPRCAP1\n'
+CAPTURE_HEADER = struct.Struct('<dcH')
+CAPTURE_MAX_DATA = 65535
+CAPTURE_OUT = b'>'
+CAPTURE_IN = b'<'
+# end of an answer of the amp, the received bytes are recorded when it is reached
+CAPTURE_EOL = b'\r\r\n'
+
+def _monotonic_clock():
+    """
+        Return a monotonic clock function, time.monotonic only exists since python 3.3
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        import ctypes
+        import ctypes.util
+
+        class _timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+        def monotonic():
+            spec = _timespec()
+            # 1 is CLOCK_MONOTONIC on linux
+            if clock_gettime(1, ctypes.byref(spec)) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+            return spec.tv_sec + spec.tv_nsec * 1e-9
+
+        monotonic()
+        return monotonic
+    except (AttributeError, OSError, TypeError):
+        # os.times()[4] is monotonic too, but only with a 10ms resolution
+        return lambda: os.times()[4]
+
+# monotonic clock, also used for the freshness of the pzone params
+clock = _monotonic_clock()
+
+# -------------------------------------------------------------------------------------------------
+class Mprsg6zCaptureException(Exception):
+    """
+        Mprsg6z capture exception
+    """
+
+    def __init__(self, value):
+        Exception.__init__(self)
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+# -------------------------------------------------------------------------------------------------
+def capture_read(path):
+    """
+        Return the list of (timestamp, direction, data) records of a capture file
+
+        @param path : path of the capture file
+    """
+    records = []
+    with open(path, 'rb') as fcap:
+        if fcap.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise Mprsg6zCaptureException(u"{0} is not a mprsg6z capture file".format(path))
+        while True:
+            header = fcap.read(CAPTURE_HEADER.size)
+            if not header:
+                break
+            if len(header) < CAPTURE_HEADER.size:
+                raise Mprsg6zCaptureException(u"Truncated record header in {0}".format(path))
+            stamp, direction, length = CAPTURE_HEADER.unpack(header)
+            data = fcap.read(length)
+            if len(data) < length:
+                raise Mprsg6zCaptureException(u"Truncated record data in {0}".format(path))
+            records.append((stamp, direction, data))
+    return records
+
+# -------------------------------------------------------------------------------------------------
+class Mprsg6zRecorder:
+    """
+        Wrap a serial.Serial line and write every byte in and out to a capture file
+        The capture is only a diagnostic : an error on the capture file stops the record,
+        never the rs232 traffic
+    """
+    def __init__(self, a_serial, path, log):
+        """
+            Open a new capture file, suffixed with the start time to keep the previous captures
+
+            @param a_serial : the serial.Serial line to wrap
+            @param path : path of the capture file, without the suffix
+            @param log : log instance
+        """
+        self._ser = a_serial
+        self.log = log
+        base = u"{0}.{1}".format(path, time.strftime('%Y%m%d-%H%M%S'))
+        self.path = base
+        i = 1
+        while os.path.exists(self.path):
+            self.path = u"{0}-{1}".format(base, i)
+            i += 1
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        self._cap = os.fdopen(fd, 'wb')
+        self._cap.write(CAPTURE_MAGIC)
+        # consecutive received bytes are grouped in one record, stamped with its last byte
+        self._rx = bytearray()
+        self._rx_stamp = None
+
+    def _record(self, stamp, direction, data):
+        """
+            Append one record to the capture file and flush it, to keep the capture
+            usable if the plugin dies
+        """
+        if self._cap is None:
+            return
+        try:
+            self._cap.write(CAPTURE_HEADER.pack(stamp, direction, len(data)))
+            self._cap.write(bytes(data))
+            self._cap.flush()
+        except (IOError, OSError) as e:
+            self.log.error(u"# # # Error while writing capture file {0}, record stopped : {1}".format(self.path, e))
+            try:
+                self._cap.close()
+            except (IOError, OSError):
+                pass
+            self._cap = None
+
+    def _flush_rx(self):
+        """
+            Write the pending received bytes as one record
+        """
+        if self._rx:
+            self._record(self._rx_stamp, CAPTURE_IN, self._rx)
+            self._rx = bytearray()
+            self._rx_stamp = None
+
+    def write(self, data):
+        """
+            Send data to the amp and record it
+        """
+        self._flush_rx()
+        stamp = clock()
+        for i in range(0, max(len(data), 1), CAPTURE_MAX_DATA):
+            self._record(stamp, CAPTURE_OUT, data[i:i+CAPTURE_MAX_DATA])
+        return self._ser.write(data)
+
+    def read(self, size=1):
+        """
+            Read data from the amp and record it, an empty read is recorded as a timeout
+        """
+        data = self._ser.read(size)
+        if data:
+            self._rx_stamp = clock()
+            self._rx += data
+            while len(self._rx) >= CAPTURE_MAX_DATA:
+                self._record(self._rx_stamp, CAPTURE_IN, self._rx[:CAPTURE_MAX_DATA])
+                self._rx = self._rx[CAPTURE_MAX_DATA:]
+            if not self._rx:
+                self._rx_stamp = None
+            # _readline stops at the end of the answer without any timeout read
+            elif self._rx.endswith(CAPTURE_EOL):
+                self._flush_rx()
+        else:
+            self._flush_rx()
+            self._record(clock(), CAPTURE_IN, b'')
+        return data
+
+    def close(self):
+        """
+            Close the serial line and the capture file
+        """
+        try:
+            self._ser.close()
+        finally:
+            self._flush_rx()
+            if self._cap is not None:
+                self._cap.close()
+                self._cap = None
+
+# -------------------------------------------------------------------------------------------------
+class Mprsg6zReplaySerial:
+    """
+        Serial.serial like object answering with the bytes of a capture
+    """
+    def __init__(self, records, speed=1.0):
+        """
+            Create the replay line
+
+            @param records : list of records returned by capture_read
+            @param speed : replay speed factor, 1.0 for original timing, 0 for no wait
+        """
+        self._records = records
+        self._speed = speed
+        self._pos = 0
+        self._rx = b''
+        self._start = None
+        self.mismatches = []
+        # timings of the current command, reset by begin()
+        self.sent_at = None
+        self.out_stamp = None
+        self.in_stamp = None
+
+    def _wait(self, stamp):
+        """
+            Sleep until the replay clock reaches the capture timestamp
+        """
+        if self._start is None:
+            self._start = (clock(), stamp)
+        if self._speed:
+            delay = (stamp - self._start[1]) / self._speed - (clock() - self._start[0])
+            if delay > 0:
+                time.sleep(delay)
+
+    def begin(self):
+        """
+            Reset the timings before a new command
+        """
+        self.sent_at = None
+        self.out_stamp = None
+        self.in_stamp = None
+
+    def pending(self):
+        """
+            Return the next command of the capture, None at the end of the capture
+        """
+        for stamp, direction, data in self._records[self._pos:]:
+            if direction == CAPTURE_OUT:
+                return data
+        return None
+
+    def write(self, data):
+        """
+            Consume the next sent record of the capture, and note it if it differs from data
+        """
+        self._rx = b''
+        while self._pos < len(self._records) and self._records[self._pos][1] != CAPTURE_OUT:
+            self._pos += 1
+        if self._pos == len(self._records):
+            raise Mprsg6zCaptureException(u"Command {0!r} sent after the end of the capture".format(data))
+        stamp, direction, expected = self._records[self._pos]
+        self._pos += 1
+        self._wait(stamp)
+        if self.sent_at is None:
+            self.sent_at = clock()
+            self.out_stamp = stamp
+        if bytes(data) != expected:
+            self.mismatches.append((expected, bytes(data)))
+        return len(data)
+
+    def read(self, size=1):
+        """
+            Return the next received bytes of the capture, an empty string on a recorded timeout
+            or when the amp sent nothing more before the next command
+        """
+        if not self._rx:
+            if self._pos == len(self._records) or self._records[self._pos][1] != CAPTURE_IN:
+                return b''
+            stamp, direction, self._rx = self._records[self._pos]
+            self._pos += 1
+            self._wait(stamp)
+            if not self._rx:
+                return b''
+            self.in_stamp = stamp
+        data, self._rx = self._rx[:size], self._rx[size:]
+        return data
+
+    def close(self):
+        pass
+
+# -------------------------------------------------------------------------------------------------
+def _replay_dispatch(vamp, command):
+    """
+        Call the Mprsg6zVamp method which sends the captured command
+    """
+    cmd = command.rstrip(b'\r\n').decode('ascii')
+    if cmd.startswith('?'):
+        zone, param = cmd[1:3], cmd[3:5]
+        if zone[1] == '0':
+            if param:
+                vamp.getAllZoneOneParam(zone[0], param)
+            else:
+                vamp.getAllZoneAllParam(zone[0])
+        elif param:
+            vamp.getOneZoneOneParam(zone, param)
+        else:
+            vamp.pzone_get_one_zone_all_param(zone)
+    elif cmd.startswith('<'):
+        zone, param, value = cmd[1:3], cmd[3:5], cmd[5:7]
+        if zone[1] == '0':
+            vamp.setAllZoneOneParam(zone[0], param, value)
+        else:
+            vamp.pzone_set_one_zone_one_param(zone, param, value)
+    else:
+        raise Mprsg6zCaptureException(u"Unknown command {0!r} in the capture".format(command))
+
+def replay(vamp, path, speed=1.0):
+    """
+        Feed a capture through a Mprsg6zVamp without any amp attached and measure it
+
+        Return a dict with the number of commands, the bytes sent and received, the total
+        duration, the (command, replay latency, captured latency) of each command, the decoded
+        _pzones, the commands whose parsing failed and the sent commands which differ from the
+        capture. The replay latency runs from the command sent to its parsing done, the captured
+        latency from the command sent to the last byte received in the capture. A latency is
+        None when the command could not be sent or when the amp sent nothing.
+
+        @param vamp : Mprsg6zVamp object, not opened
+        @param path : path of the capture file
+        @param speed : replay speed factor, 1.0 for original timing, 0 for no wait
+    """
+    records = capture_read(path)
+    line = Mprsg6zReplaySerial(records, speed)
+    vamp._ser = line
+    latencies = []
+    errors = []
+    start = clock()
+    while True:
+        command = line.pending()
+        if command is None:
+            break
+        line.begin()
+        try:
+            _replay_dispatch(vamp, command)
+        except Exception as e:
+            # a failed parse is a result of the replay, not a reason to stop it
+            errors.append((command, repr(e)))
+            # skip the remaining records of this command
+            if line.pending() is command:
+                line.write(command)
+        end = clock()
+        latency = captured = None
+        if line.sent_at is not None:
+            latency = end - line.sent_at
+            if line.in_stamp is not None:
+                captured = line.in_stamp - line.out_stamp
+        latencies.append((command, latency, captured))
+    return {
+        'commands': len(latencies),
+        'bytes_out': sum(len(data) for stamp, direction, data in records if direction == CAPTURE_OUT),
+        'bytes_in': sum(len(data) for stamp, direction, data in records if direction == CAPTURE_IN),
+        'duration': clock() - start,
+        'latencies': latencies,
+        'pzones': copy.deepcopy(vamp._pzones),
+        'errors': errors,
+        'mismatches': line.mismatches
+    }
+
+# -------------------------------------------------------------------------------------------------
+if __name__ == "__main__":
+    import argparse
+    import logging
+    from domogik_packages.plugin_mprsg6z.lib.mprsg6z import Mprsg6zVamp
+
+    parser = argparse.ArgumentParser(description=u"Replay a mprsg6z capture without any amp attached")
+    parser.add_argument('capture', help=u"capture file written by the plugin")
+    parser.add_argument('--speed', type=float, default=1.0, help=u"replay speed factor, 0 for no wait (default 1.0)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    channels = dict(('0' + str(i), 'Channel' + str(i)) for i in range(1, 7))
+    result = replay(Mprsg6zVamp(logging.getLogger('mprsg6z'), channels, u"replay of {0}".format(args.capture)), args.capture, args.speed)
+    print(u"{0} commands, {1} bytes out, {2} bytes in, {3:.3f}s".format(result['commands'], result['bytes_out'], result['bytes_in'], result['duration']))
+    for command, latency, captured in result['latencies']:
+        latency = u"-" if latency is None else u"{0:.3f}s".format(latency)
+        captured = u"-" if captured is None else u"{0:.3f}s".format(captured)
+        print(u"{0:>12} replay {1} captured {2}".format(command.rstrip(b'\r\n').decode('latin-1').encode('ascii', 'backslashreplace').decode('ascii'), latency, captured))
+    for command, error in result['errors']:
+        print(u"Error on {0!r} : {1}".format(command, error))
+    for expected, sent in result['mismatches']:
+        print(u"Sent {0!r} instead of {1!r}".format(sent, expected))
+    for zone in sorted(result['pzones']):
+        print(u"{0} {1}".format(zone, result['pzones'][zone]))
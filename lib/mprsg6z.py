@@ -38,6 +38,10 @@ import serial
 import traceback
 import time
 import re
+import threading
+
+from domogik_packages.plugin_mprsg6z.lib.capture import Mprsg6zRecorder
+from domogik_packages.plugin_mprsg6z.lib.capture import clock
 
 PZONE_DEFAULT = {
   "PA":"00",
@@ -73,6 +77,33 @@ PZONE_TO_VZONE = {
   'CH'
 }
 
+# order of the params in the 20 characters status of a pzone
+PZONE_STATUS = [
+  'PA',
+  'PR',
+  'MU',
+  'DT',
+  'VO',
+  'TR',
+  'BS',
+  'BL',
+  'CH',
+  'LS'
+]
+
+# source of the last confirmed value of a pzone param
+SOURCE_STARTUP = "startup"
+SOURCE_POLL = "poll"
+SOURCE_WRITE = "write"
+# a written value is not confirmed by the amp until it is polled
+SOURCES_CONFIRMED = (SOURCE_STARTUP, SOURCE_POLL)
+
+# maximum age in seconds of the pzone params refreshed by the main loop
+VZONE_MAX_AGE = 60
+# params of the pzone childs refreshed by the main loop : the params copied to the vzones
+# and PR, written by the PO command
+VZONE_REFRESH = PZONE_TO_VZONE | {'PR'}
+
 # -------------------------------------------------------------------------------------------------
 class Mprsg6zException(Exception):
     """
@@ -91,29 +122,38 @@ class Mprsg6zVamp:
     """
         Create python object and methods to interact with amps via rs232
     """
-    def __init__(self, log, channels, device='/dev/ttyUSB0'):
+    def __init__(self, log, channels, device='/dev/ttyUSB0', capture=''):
         """
             Create python object virtual amp
 
             @param log : log instance
             @param channels : dict with descrption of the 6 input channel
             @param device : rs232 device (default /dev/ttyUSB0)
+            @param capture : file to record the rs232 traffic to (default '', no record)
         """
 
         self.log = log 
         self.channels = channels
         self.device = device
+        self.capture = capture
+        # serialize the query/answer exchanges with the amp and the updates of _pzones{}
+        self._lock = threading.RLock()
 	self._vzones = {}
 	self._vzones_old = {}
 
         # dict to store running params of pzones
         self._pzones = {}
+        # dict to store (monotonic clock, source, wall time) of the last update of each param of pzones
+        # default values are never confirmed : (None, None, None)
+        self._pzones_fresh = {}
         for i in range(1, 4):
             for j in range(1, 7):
                 zone = str(i) + str(j)
                 self._pzones[zone] = {}
+                self._pzones_fresh[zone] = {}
                 for cle, valeur in PZONE_DEFAULT.items(): 
                     self._pzones[zone][cle] = valeur
+                    self._pzones_fresh[zone][cle] = (None, None, None)
                 self._pzones[zone]['slaveof'] = []
                 self._pzones[zone]['lockedby'] = ""
 	self.log.info(u"= = > Virtual Amp created : channels : {0}, device : {1}.".format(self.channels, self.device))
@@ -130,6 +170,13 @@ class Mprsg6zVamp:
         except:
             error = u"Error while opening device : {}".format(self.device)
             raise Mprsg6zException(error)
+        if self.capture:
+            try:
+                self._ser = Mprsg6zRecorder(self._ser, self.capture, self.log)
+                self.log.info(u"= = > Virtual Amp rs232 traffic recorded to {0}.".format(self._ser.path))
+            except (IOError, OSError):
+                error = u"Error while opening capture file : {}".format(self.capture)
+                raise Mprsg6zException(error)
 
 
     def close(self):
@@ -161,36 +208,139 @@ class Mprsg6zVamp:
                 break
         return bytes(line)
 
+    def _readanswer(self, regexp, eol=b'\r\r\n'):
+        """
+            Read the answer of the amp to a status query and return the matches of regexp
+
+            @param regexp : regexp to search in the answer
+            @param eol : end of the answer (default \\r\\r\\n)
+        """
+        try:
+            rcv = self._readline(self._ser, eol)
+        except (serial.SerialException, IOError, OSError):
+            error = u"Error while reading device : {}".format(self.device)
+            raise Mprsg6zException(error)
+        reponse = re.findall(regexp, rcv)
+        if not reponse:
+            error = u"Bad answer received from device {0} : {1!r}".format(self.device, rcv)
+            raise Mprsg6zException(error)
+        return reponse
+
     # -------------------------------------------------------------------------------------------------
 
-    def pzone_get_one_zone_all_param(self, p_zone):
+    def _pzone_update(self, p_zone, param, value, source):
+        """
+            Update a param of the dict _pzones{} and its last update time
+
+            @param p_zone : the physical zone to update
+            @param param : the param to update
+            @param value : the value of the param
+            @param source : SOURCE_STARTUP, SOURCE_POLL or SOURCE_WRITE
+        """
+        with self._lock:
+            self._pzones[p_zone][param] = value
+            self._pzones_fresh[p_zone][param] = (clock(), source, time.time())
+
+    def _pzone_update_status(self, p_zone, status, source):
+        """
+            Update all params of the dict _pzones{} with the 20 characters status of a pzone
+
+            @param p_zone : the physical zone to update
+            @param status : the status returned by the amp
+            @param source : SOURCE_STARTUP, SOURCE_POLL or SOURCE_WRITE
+        """
+        # a frame split by a _readline timeout gives a shorter status
+        if len(status) != 2*len(PZONE_STATUS):
+            error = u"Bad status received for pzone {0} : {1!r}".format(p_zone, status)
+            raise Mprsg6zException(error)
+        with self._lock:
+            for i, param in enumerate(PZONE_STATUS):
+                self._pzone_update(p_zone, param, status[2*i:2*i+2], source)
+
+    def pzone_is_fresh(self, p_zone, param, max_age=None, sources=SOURCES_CONFIRMED):
+        """
+            Return True if the value of a pzone param is confirmed and not older than max_age
+
+            @param p_zone : the physical zone
+            @param param : the param
+            @param max_age : maximum age in seconds of the value (default None, any age)
+            @param sources : list of accepted sources (default SOURCES_CONFIRMED)
+        """
+        stamp, source, wall = self._pzones_fresh[p_zone][param]
+        if stamp is None or source not in sources:
+            return False
+        return max_age is None or clock() - stamp <= max_age
+
+    def pzone_refresh_stale(self, p_zone, params, max_age=None, sources=SOURCES_CONFIRMED):
+        """
+            Pull the stale params of a physical zone with the cheapest query :
+            one param status if only one is stale, the whole zone status otherwise
+
+            @param p_zone : the physical zone
+            @param params : list of the params wanted
+            @param max_age : maximum age in seconds of the values (default None, any age)
+            @param sources : list of accepted sources (default SOURCES_CONFIRMED)
+        """
+        with self._lock:
+            stale = [param for param in params if not self.pzone_is_fresh(p_zone, param, max_age, sources)]
+            if len(stale) == 1:
+                self.getOneZoneOneParam(p_zone, stale[0])
+            elif stale:
+                self.pzone_get_one_zone_all_param(p_zone)
+        return dict((param, self._pzones[p_zone][param]) for param in params)
+
+    def pzone_get_fresh(self, p_zone, param, max_age=None, sources=SOURCES_CONFIRMED):
+        """
+            Return the value of a pzone param not older than max_age, pull it from the amp if needed
+
+            @param p_zone : the physical zone
+            @param param : the param
+            @param max_age : maximum age in seconds of the value (default None, any age)
+            @param sources : list of accepted sources (default SOURCES_CONFIRMED)
+        """
+        return self.pzone_refresh_stale(p_zone, [param], max_age, sources)[param]
+
+    def pamp_get_fresh(self, p_amp, param, max_age=None, sources=SOURCES_CONFIRMED):
+        """
+            Return the values of one param for all zones of an amp not older than max_age
+            Pull them from the amp with the cheapest query if needed
+
+            @param p_amp : the physical amp
+            @param param : the param
+            @param max_age : maximum age in seconds of the values (default None, any age)
+            @param sources : list of accepted sources (default SOURCES_CONFIRMED)
+        """
+        zones = [str(p_amp) + str(j) for j in range(1, 7)]
+        with self._lock:
+            stale = [zone for zone in zones if not self.pzone_is_fresh(zone, param, max_age, sources)]
+            if len(stale) == 1:
+                self.getOneZoneOneParam(stale[0], param)
+            elif stale:
+                self.getAllZoneOneParam(str(p_amp), param)
+        return [self._pzones[zone][param] for zone in zones]
+
+    # -------------------------------------------------------------------------------------------------
+
+    def pzone_get_one_zone_all_param(self, p_zone, source=SOURCE_POLL):
         """
             Pull all params of a physical zone and update the dict _pzones{} with it
 
             @param p_zone : physical zone of the amp to pull
+            @param source : source of the values (default SOURCE_POLL)
         """
-	command = '?' + str(p_zone) + '\r\n'
-        try:
-            self._ser.write(command)
-            self.log.debug(u"= = = > Command {0} sent to the amp".format(command.rstrip()))
-        except:
-            error = "Error while polling device : {}".format(self.dev)
-            raise Mprsg6zException(error)
-            
-        rcv = self._readline(self._ser)
-	regexp = '>' + p_zone + '(.+?)\\r\\r\\n'
-        reponse = re.search(regexp, rcv).group(1)
-	# update _pzones with result
-        self._pzones[p_zone]['PA'] = reponse[0:2]
-        self._pzones[p_zone]['PR'] = reponse[2:4]
-        self._pzones[p_zone]['MU'] = reponse[4:6]
-        self._pzones[p_zone]['DT'] = reponse[6:8]
-        self._pzones[p_zone]['VO'] = reponse[8:10]
-        self._pzones[p_zone]['TR'] = reponse[10:12]
-        self._pzones[p_zone]['BS'] = reponse[12:14]
-        self._pzones[p_zone]['BL'] = reponse[14:16]
-        self._pzones[p_zone]['CH'] = reponse[16:18]
-        self._pzones[p_zone]['LS'] = reponse[18:20]
+        command = '?' + str(p_zone) + '\r\n'
+        with self._lock:
+            try:
+                self._ser.write(command)
+                self.log.debug(u"= = = > Command {0} sent to the amp".format(command.rstrip()))
+            except:
+                error = u"Error while polling device : {}".format(self.device)
+                raise Mprsg6zException(error)
+
+            regexp = '>' + p_zone + '(.+?)\\r\\r\\n'
+            reponse = self._readanswer(regexp)[0]
+            # update _pzones with result
+            self._pzone_update_status(p_zone, reponse, source)
 
     # -------------------------------------------------------------------------------------------------
 
@@ -205,14 +355,15 @@ class Mprsg6zVamp:
         """
 	command = '<' + str(p_zone) + str(param) + str(value) + '\r\n'
         try:
-            self._ser.write(command)
+            with self._lock:
+                self._ser.write(command)
             self.log.debug(u"= = = > Command {0} sent to the amp".format(command.rstrip()))
         except:
             error = "Error while polling device : {}".format(self.device)
             raise Mprsg6zException(error)
 
-	# update _pzones with result
-	self._pzones[p_zone][param] = value 
+	# update _pzones with result, not confirmed by the amp
+        self._pzone_update(p_zone, param, value, SOURCE_WRITE)
 
     # -------------------------------------------------------------------------------------------------
 
@@ -241,7 +392,7 @@ class Mprsg6zVamp:
             if not flag:
 		self._vzones[deviceid]['Status'] = 'off'
         # we launch update.param of the first child
-	self.pzone_get_one_zone_all_param(self._vzones[deviceid]['childs'][0])
+	self.pzone_get_one_zone_all_param(self._vzones[deviceid]['childs'][0], SOURCE_STARTUP)
         # copy of the interesting parameter of the first child of the _vzone
        	for cle in PZONE_TO_VZONE:
             self._vzones[deviceid][cle] = self._pzones[self._vzones[deviceid]['childs'][0]][cle]
@@ -338,6 +489,13 @@ class Mprsg6zVamp:
         self.log.info(u"= = > Internal loop to keep sync _pzones and _vzones started for {0} vzones.".format(len(self._vzones)))
 	while not stop.isSet():
             for zone in self._vzones:
+                # pull from the amp only the params of the childs older than VZONE_MAX_AGE
+                # or written and not yet confirmed
+                for child in self._vzones[zone]["childs"]:
+                    try:
+                        self.pzone_refresh_stale(child, VZONE_REFRESH, VZONE_MAX_AGE)
+                    except Mprsg6zException as e:
+                        self.log.error(u"# # # Error while refreshing pzone {0} of vzone {1} : {2}".format(child, zone, e.value))
 	        for cle in PZONE_TO_VZONE:
                     self._vzones[zone][cle] = self._pzones[self._vzones[zone]["childs"][0]][cle]
                     diffparams = [param for param in self._vzones[zone] if self._vzones[zone][param] != self._vzones_old[zone][param]]
@@ -350,32 +508,73 @@ class Mprsg6zVamp:
 	        stop.wait(1)
         self.close()
 
+    # -------------------------------------------------------------------------------------------------
+
+    def vamp_snapshot(self):
+        """
+        Return the whole state of the vamp from the cached _pzones{} and _vzones{},
+        without any query to the amp. Only made of dict, list, string and number
+        to be sent over MQ. Built under the lock, so each value matches its freshness.
+        """
+        with self._lock:
+            now = clock()
+            snapshot = {'time': time.time(), 'channels': dict(self.channels), 'pzones': {}, 'vzones': {}}
+            for zone in self._pzones:
+                params = {}
+                for param in PZONE_STATUS:
+                    stamp, source, wall = self._pzones_fresh[zone][param]
+                    params[param] = {
+                        'value': self._pzones[zone][param],
+                        'time': wall,
+                        'age': None if stamp is None else now - stamp,
+                        'source': source
+                    }
+                snapshot['pzones'][zone] = {
+                    'params': params,
+                    'slaveof': list(self._pzones[zone]['slaveof']),
+                    'lockedby': self._pzones[zone]['lockedby']
+                }
+            for device_id in self._vzones:
+                snapshot['vzones'][device_id] = {
+                    'name': self._vzones[device_id]['name'],
+                    'Status': self._vzones[device_id]['Status'],
+                    'childs': list(self._vzones[device_id]['childs']),
+                    'params': dict((cle, self._vzones[device_id][cle]) for cle in PZONE_TO_VZONE),
+                    'channel': self.channels.get(self._vzones[device_id]['CH'], self._vzones[device_id]['CH'])
+                }
+        return snapshot
+
 # Unused -------------------------------------------------------------------------------------------------
 
-    def getVzoneOneParam(self, param):
+    def getVzoneOneParam(self, device_id, param):
         """ 
         Return one param of the first p_zone of childs v_zone
 
         Keyword arguments:
+        device_id -- device id of the vzone
         param -- param to pull
         """
 
         # return only the param of the first p_zone of the v_zone
-  	# if we want to know th CH parameter, we use the channels dict of
-    	# the v_amp object
-	if param == "CH":
-	    return(param, self.v_amp_obj.channels[self.v_amp_obj._pzones[self.v_params["childs"][0]][param]])
-	else:
-            value = self.v_amp_obj._pzones[self.v_params["childs"][0]][param]
+        # if we want to know th CH parameter, we use the channels dict of
+        # the vamp
+        value = self._pzones[self._vzones[device_id]["childs"][0]][param]
+        if param == "CH":
+            return(param, self.channels.get(value, value))
+        else:
             return(param, value)
 
-    def getVzoneAllParam(self):
+    def getVzoneAllParam(self, device_id):
         """ 
         Return all param of the first p_zone of childs v_zone
+
+        Keyword arguments:
+        device_id -- device id of the vzone
         """
 
         # return only the params of the first p_zone of the v_zone
-        return(self.v_amp_obj._pzones[self.v_params["childs"][0]])
+        pzone = self._pzones[self._vzones[device_id]["childs"][0]]
+        return(dict((param, pzone[param]) for param in PZONE_STATUS))
 
     def setAllZoneOneParam(self, p_amp, param, value):
         """
@@ -387,14 +586,15 @@ class Mprsg6zVamp:
         param -- the param to set
         value -- value to set
         """
-        try:
-            self._ser.write('<' + p_amp + '0' + param + value + '\r\n')
-        except:
-            error = "Error while polling device : {}".format(self.device)
-            raise Mprsg6zException(error)
+        with self._lock:
+            try:
+                self._ser.write('<' + p_amp + '0' + param + value + '\r\n')
+            except:
+                error = u"Error while polling device : {}".format(self.device)
+                raise Mprsg6zException(error)
 
-        # Finally, we update the params{} and return the updated data
-        return self.getAllZoneOneParam(p_amp, param)
+            # Finally, we update the params{} and return the updated data
+            return self.getAllZoneOneParam(p_amp, param)
 
     def getAllZoneAllParam(self, p_amp):
         """
@@ -404,33 +604,22 @@ class Mprsg6zVamp:
         Keyword arguments:
         p_amp -- amp to pull
         """
-        try:
-            self._ser.write('?' + p_amp + '0\r\n\n')
-        except:
-            error = "Error while polling device : {}".format(self.dev)
-            raise Mprsg6zException(error)
-
-        rcv = self._readline(self._ser, eol=b'\r\r\n\n')
-	regexp = '>' + p_amp + '[1-6]{1}(.+?)\\r\\r\\n'
-        # Return a list with all params of each zone in
-        # the right order
-        reponse = re.findall(regexp, rcv)
-        i = 1
-	var = {}
-        for elt in reponse:
-            zone = p_amp + str(i) 
-            self._pzones[zone]['PA'] = elt[0:2]
-            self._pzones[zone]['PR'] = elt[2:4]
-            self._pzones[zone]['MU'] = elt[4:6]
-            self._pzones[zone]['DT'] = elt[6:8]
-            self._pzones[zone]['VO'] = elt[8:10]
-            self._pzones[zone]['TR'] = elt[10:12]
-            self._pzones[zone]['BS'] = elt[12:14]
-            self._pzones[zone]['BL'] = elt[14:16]
-            self._pzones[zone]['CH'] = elt[16:18]
-            self._pzones[zone]['LS'] = elt[18:20]
-	    var[zone] = self._pzones[zone]
-            i += 1
+        with self._lock:
+            try:
+                self._ser.write('?' + p_amp + '0\r\n\n')
+            except:
+                error = u"Error while polling device : {}".format(self.device)
+                raise Mprsg6zException(error)
+
+            regexp = '>' + p_amp + '[1-6]{1}(.+?)\\r\\r\\n'
+            # Return a list with all params of each zone in
+            # the right order
+            reponse = self._readanswer(regexp, eol=b'\r\r\n\n')
+            i = 1
+            for elt in reponse:
+                zone = p_amp + str(i)
+                self._pzone_update_status(zone, elt, SOURCE_POLL)
+                i += 1
 
     def getVampAll(self):
         """
@@ -450,23 +639,23 @@ class Mprsg6zVamp:
         p_amp -- amp to pull
         param -- param to pull
         """
-        try:
-            self._ser.write('?' + p_amp + '0' + param + '\r\n')
-        except:
-            error = "Error while polling device : {}".format(self.dev)
-            raise Mprsg6zException(error)
-
-        rcv = self._readline(self._ser, eol=b'\r\r\n\n')
-	regexp = '>' + p_amp + '[1-6]{1}[A-Z]{2}(.+?)\\r\\r\\n'
-        reponse = re.findall(regexp, rcv)
-        i = 1
-        var = []
-        for elt in reponse:
-            zone = p_amp + str(i) 
-            self._pzones[zone][str(param)] = elt
-            var.append(self._pzones[zone][str(param)])
-            i += 1
-	return(p_amp + '0',param,var)
+        with self._lock:
+            try:
+                self._ser.write('?' + p_amp + '0' + param + '\r\n')
+            except:
+                error = u"Error while polling device : {}".format(self.device)
+                raise Mprsg6zException(error)
+
+            regexp = '>' + p_amp + '[1-6]{1}[A-Z]{2}(.+?)\\r\\r\\n'
+            reponse = self._readanswer(regexp, eol=b'\r\r\n\n')
+            i = 1
+            var = []
+            for elt in reponse:
+                zone = p_amp + str(i)
+                self._pzone_update(zone, str(param), elt, SOURCE_POLL)
+                var.append(self._pzones[zone][str(param)])
+                i += 1
+        return(p_amp + '0',param,var)
 
     def getOneZoneOneParam(self, p_zone, param):
         """
@@ -477,15 +666,15 @@ class Mprsg6zVamp:
         p_zone -- p_zone to pull
         param -- param to pull
         """
-        try:
-            self._ser.write('?' + p_zone + param + '\r\n')
-        except:
-            error = "Error while polling device : {}".format(self.dev)
-            raise Mprsg6zException(error)
-
-        rcv = self._readline(self._ser)
-	regexp = '>' + p_zone + param + '(.+?)\\r\\r\\n'
-        reponse = re.search(regexp, rcv).group(1)
-        self._pzones[p_zone][param] = reponse
+        with self._lock:
+            try:
+                self._ser.write('?' + p_zone + param + '\r\n')
+            except:
+                error = u"Error while polling device : {}".format(self.device)
+                raise Mprsg6zException(error)
+
+            regexp = '>' + p_zone + param + '(.+?)\\r\\r\\n'
+            reponse = self._readanswer(regexp)[0]
+            self._pzone_update(p_zone, param, reponse, SOURCE_POLL)
         return(p_zone, param, reponse)
 # -------------------------------------------------------------------------------------------------
@@ -0,0 +1,185 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+""" This file is part of B{Domogik} project (U{http://www.domogik.org}).
+
+License
+=======
+
+B{Domogik} is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+B{Domogik} is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Domogik. If not, see U{http://www.gnu.org/licenses}.
+
+Plugin purpose
+==============
+
+Plugin for monoprice mpr-6zhmaut amp
+
+Implements
+==========
+
+Tests of the freshness of the pzone params, with a fake amp : no hardware needed
+
+@author: jaywax  (jaywax dt 2 dt bourbon at gmail dt com)
+@copyright: (C) 2007-2017 Domogik project
+@license: GPL(v3)
+@organization: Domogik
+"""
+
+import logging
+import unittest
+
+from domogik_packages.plugin_mprsg6z.lib.mprsg6z import Mprsg6zVamp
+from domogik_packages.plugin_mprsg6z.lib.mprsg6z import Mprsg6zException
+from domogik_packages.plugin_mprsg6z.lib.mprsg6z import SOURCE_POLL, SOURCE_STARTUP, SOURCE_WRITE
+
+
+class FakeAmp:
+    """
+        Serial.serial like object answering the status queries like an amp
+        Each zone status is 0001000020070710010 followed by the last digit of the zone
+    """
+    def __init__(self):
+        self.sent = []
+        self.fail = False
+        self._rx = b''
+
+    def _status(self, zone):
+        return '000100002007071001' + '0' + zone[1]
+
+    def write(self, data):
+        command = data.rstrip('\r\n')
+        self.sent.append(command)
+        if not command.startswith('?'):
+            return len(data)
+        zone, param = command[1:3], command[3:5]
+        zones = [zone[0] + str(j) for j in range(1, 7)] if zone[1] == '0' else [zone]
+        for z in zones:
+            status = self._status(z)
+            if param:
+                i = ['PA', 'PR', 'MU', 'DT', 'VO', 'TR', 'BS', 'BL', 'CH', 'LS'].index(param)
+                self._rx += '>' + z + param + status[2*i:2*i+2] + '\r\r\n'
+            else:
+                self._rx += '>' + z + status + '\r\r\n'
+        if zone[1] == '0':
+            self._rx += '\n'
+        return len(data)
+
+    def read(self, size=1):
+        if self.fail:
+            raise IOError(5, 'Input/output error')
+        data, self._rx = self._rx[:size], self._rx[size:]
+        return data
+
+    def close(self):
+        pass
+
+
+class OneLoopEvent:
+    """
+        Stop event of the main loop, set after the first wait
+    """
+    def __init__(self):
+        self._set = False
+
+    def isSet(self):
+        return self._set
+
+    def wait(self, timeout):
+        self._set = True
+
+
+class FreshnessTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.vamp = Mprsg6zVamp(logging.getLogger('mprsg6z_tests'), {'01': 'Channel1'}, 'fake')
+        self.amp = FakeAmp()
+        self.vamp._ser = self.amp
+
+    def age(self, p_zone, param, seconds):
+        stamp, source, wall = self.vamp._pzones_fresh[p_zone][param]
+        self.vamp._pzones_fresh[p_zone][param] = (stamp - seconds, source, wall)
+
+    def test_default_values_are_stale(self):
+        self.assertFalse(self.vamp.pzone_is_fresh('11', 'VO'))
+        self.assertEqual(self.vamp.pzone_get_fresh('11', 'VO', 60), '20')
+        self.assertEqual(self.amp.sent, ['?11VO'])
+        self.assertEqual(self.vamp._pzones_fresh['11']['VO'][1], SOURCE_POLL)
+
+    def test_fresh_value_sends_nothing(self):
+        self.vamp.pzone_get_one_zone_all_param('11', SOURCE_STARTUP)
+        self.assertEqual(self.vamp.pzone_get_fresh('11', 'CH', 60), '01')
+        self.assertEqual(self.amp.sent, ['?11'])
+
+    def test_one_stale_param_of_a_zone(self):
+        self.vamp.pzone_get_one_zone_all_param('12')
+        self.age('12', 'TR', 120)
+        self.vamp.pzone_refresh_stale('12', ['VO', 'TR', 'BS'], 60)
+        self.assertEqual(self.amp.sent, ['?12', '?12TR'])
+
+    def test_several_stale_params_of_a_zone(self):
+        self.vamp.pzone_get_one_zone_all_param('12')
+        self.age('12', 'TR', 120)
+        self.age('12', 'BS', 120)
+        self.vamp.pzone_refresh_stale('12', ['VO', 'TR', 'BS'], 60)
+        self.assertEqual(self.amp.sent, ['?12', '?12'])
+
+    def test_one_stale_zone_of_an_amp(self):
+        self.vamp.getAllZoneOneParam('2', 'LS')
+        self.age('24', 'LS', 120)
+        self.assertEqual(self.vamp.pamp_get_fresh('2', 'LS', 60), ['01', '02', '03', '04', '05', '06'])
+        self.assertEqual(self.amp.sent, ['?20LS', '?24LS'])
+
+    def test_several_stale_zones_of_an_amp(self):
+        self.vamp.pzone_get_one_zone_all_param('31')
+        self.vamp.pamp_get_fresh('3', 'VO', 60)
+        self.assertEqual(self.amp.sent, ['?31', '?30VO'])
+
+    def test_written_value_stays_stale(self):
+        self.vamp.pzone_get_one_zone_all_param('11')
+        self.vamp.pzone_set_one_zone_one_param('11', 'VO', '15')
+        self.assertEqual(self.vamp._pzones_fresh['11']['VO'][1], SOURCE_WRITE)
+        self.assertFalse(self.vamp.pzone_is_fresh('11', 'VO', 60))
+        self.assertTrue(self.vamp.pzone_is_fresh('11', 'VO', 60, (SOURCE_POLL, SOURCE_WRITE)))
+        # the fake amp did not apply the write : the poll gives the real value
+        self.assertEqual(self.vamp.pzone_get_fresh('11', 'VO', 60), '20')
+        self.assertEqual(self.amp.sent, ['?11', '<11VO15', '?11VO'])
+
+    def test_short_status_is_rejected(self):
+        self.amp._status = lambda zone: '0001'
+        self.assertRaises(Mprsg6zException, self.vamp.pzone_get_one_zone_all_param, '11')
+        self.assertEqual(self.vamp._pzones_fresh['11']['PA'][0], None)
+
+    def test_read_error_is_a_mprsg6z_exception(self):
+        self.amp.fail = True
+        self.assertRaises(Mprsg6zException, self.vamp.getOneZoneOneParam, '11', 'VO')
+
+    def test_loop_confirms_power_of_childs(self):
+        self.vamp.vzone_add(1, 'salon', '11,12')
+        self.vamp.pzone_get_one_zone_all_param('12')
+        self.vamp.vzone_set_one_command(1, 'PO', '')
+        del self.amp.sent[:]
+        self.vamp.loop_vzones_update(lambda device_id, value: None, OneLoopEvent())
+        self.assertEqual(self.amp.sent, ['?11PR', '?12PR'])
+        self.assertEqual(self.vamp._pzones_fresh['12']['PR'][1], SOURCE_POLL)
+
+    def test_loop_survives_read_errors(self):
+        self.vamp.vzone_add(1, 'salon', '11')
+        self.vamp.vzone_set_one_command(1, 'PO', '')
+        self.amp.fail = True
+        # an error escaping the loop would fail the test
+        self.vamp.loop_vzones_update(lambda device_id, value: None, OneLoopEvent())
+        self.assertFalse(self.vamp.pzone_is_fresh('11', 'PR', 60))
+
+
+if __name__ == "__main__":
+    unittest.main()